@@ -1,18 +1,69 @@
 import os
-import json
+import hashlib
+import orjson
 import time
 import redis
 import ffmpeg
 import cv2
+import numpy as np
+import numba
+import queue
+import signal
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-redis_client = redis.from_url(
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 8))
+
+# 整个进程共用一个连接池：BLPOP 主循环 + 每个任务线程各占一个连接
+_POOL = redis.ConnectionPool.from_url(
     os.environ["REDIS_URL"],
+    max_connections=max(32, WORKER_CONCURRENCY + 2),
     decode_responses=True
 )
+redis_client = redis.Redis(connection_pool=_POOL)
 
 print("🔌 Redis connected in Worker")
 
+# 同时在跑的任务不超过线程数，满了就先不取新任务
+EXECUTOR = ThreadPoolExecutor(max_workers=WORKER_CONCURRENCY)
+_inflight = threading.BoundedSemaphore(WORKER_CONCURRENCY)
+
+# SIGTERM 置位，主循环在两次 BLPOP 之间检查后退出
+_shutdown = threading.Event()
+
+def _detect_cuda_ffmpeg():
+    # ffmpeg 编进了 cuda/nvenc 不代表有显卡，试编码一小段确认
+    try:
+        hwaccels = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-hwaccels"],
+            capture_output=True, text=True, timeout=10
+        ).stdout
+        if "cuda" not in hwaccels.split():
+            return False
+
+        probe = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error",
+             "-f", "lavfi", "-i", "color=size=256x256:duration=0.1",
+             "-c:v", "h264_nvenc", "-f", "null", "-"],
+            capture_output=True, timeout=30
+        )
+        return probe.returncode == 0
+    except subprocess.TimeoutExpired as e:
+        print(f"⚠️ ffmpeg 硬件探测超时，改用 libx264: {e.cmd}")
+        return False
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+
+FFMPEG_CUDA = _detect_cuda_ffmpeg()
+FFMPEG_INPUT_ARGS = {'hwaccel': 'cuda'} if FFMPEG_CUDA else {}
+FFMPEG_VCODEC = 'h264_nvenc' if FFMPEG_CUDA else 'libx264'
+
+print(f"🎞️ ffmpeg 编码器: {FFMPEG_VCODEC}")
+
+
 def process_video_task(task_data):
     print(f"正在处理任务: {task_data}")
 
@@ -20,16 +71,10 @@ def process_video_task(task_data):
     task_id = task_data.get('task_id')
 
     try:
-        if task_type == 'video_generation':
-            result = generate_video_with_sora(task_data)
-        elif task_type == 'video_analysis':
-            result = analyze_video_style(task_data)
-        elif task_type == 'digital_human':
-            result = generate_digital_human_video(task_data)
-        elif task_type == 'video_processing':
-            result = process_video_file(task_data)
-        else:
+        handler = _TASK_HANDLERS.get(task_type)
+        if handler is None:
             raise ValueError(f"未知任务类型: {task_type}")
+        result = handler(task_data)
 
         update_task_status(task_id, "completed", 100, result)
         print(f"✅ 任务完成: {task_id}")
@@ -57,54 +102,119 @@ def generate_video_with_sora(task_data):
     }
 
 
+# 不开 parallel：多个任务线程会同时调用，并发已由线程池提供，
+# 再开 numba 线程会超额占用 CPU，workqueue 线程层下并发调用还会直接 abort
+# nogil：计算期间释放 GIL，线程池里的分析任务、BLPOP 主循环和状态写入线程才能并行
+@numba.njit(nogil=True, fastmath=True, cache=True)
+def _brightness_motion(frames):
+    # 一次遍历同时算亮度和相邻帧差，不生成 int16 中间数组
+    n, h, w = frames.shape
+    brightness = 0.0
+    motion = 0.0
+    for i in range(n):
+        b = 0
+        m = 0
+        if i == 0:
+            for y in range(h):
+                for x in range(w):
+                    b += np.int64(frames[0, y, x])
+        else:
+            for y in range(h):
+                for x in range(w):
+                    v = np.int64(frames[i, y, x])
+                    b += v
+                    m += abs(v - np.int64(frames[i - 1, y, x]))
+        brightness += b
+        motion += m
+    # 亮度为全部像素均值，运动分为每对相邻帧平均差之和
+    return brightness / (n * h * w), motion / (h * w)
+
+
 def analyze_video_style(task_data):
     video_path = task_data.get('video_path')
 
     if not video_path or not os.path.exists(video_path):
         raise FileNotFoundError(f"视频文件不存在: {video_path}")
 
+    # 同一文件（路径 + 大小 + 修改时间）的分析结果缓存一天，no_cache 可跳过
+    # 缓存只是优化：Redis 出错时打日志，照常分析
+    use_cache = not task_data.get('no_cache')
+    if use_cache:
+        stat = os.stat(video_path)
+        cache_key = "analysis_cache:" + hashlib.sha256(orjson.dumps(
+            {"path": os.path.abspath(video_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns},
+            option=orjson.OPT_SORT_KEYS
+        )).hexdigest()
+
+        try:
+            cached = redis_client.get(cache_key)
+        except Exception as e:
+            print(f"⚠️ 读取分析缓存失败: {str(e)}")
+            cached = None
+        if cached:
+            print(f"命中分析缓存: {video_path}")
+            return orjson.loads(cached)
+
     print(f"分析视频风格: {video_path}")
 
     cap = cv2.VideoCapture(video_path)
-    frames = []
 
     frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     fps = cap.get(cv2.CAP_PROP_FPS)
-
-    for i in range(0, frame_count, int(fps)):
-        cap.set(cv2.CAP_PROP_POS_FRAMES, i)
-        ret, frame = cap.read()
+    step = int(fps)
+    sample_indices = range(0, frame_count, step)
+
+    # 只用到 B 通道（与 cv2.mean(frame)[0] 一致），预分配 (N, H, W)
+    frames = None
+    n_frames = 0
+    # 逐帧循环里的方法查找提到循环外
+    grab = cap.grab
+    retrieve = cap.retrieve
+    # 顺序读取：每帧只 grab 解码一次（FFmpeg 后端 grab 即解码，retrieve 只做色彩转换），
+    # 采样帧才 retrieve；避免每次 seek 回关键帧重新解码
+    for i in range(frame_count):
+        if not grab():
+            break
+        if i % step:
+            continue
+        ret, frame = retrieve()
         if ret:
-            frames.append(frame)
+            if frames is None:
+                frames = np.empty((len(sample_indices),) + frame.shape[:2], dtype=np.uint8)
+            frames[n_frames] = frame[:, :, 0]
+            n_frames += 1
 
     cap.release()
 
     style_tags = []
-    if len(frames) > 0:
-        avg_brightness = sum(cv2.mean(frame)[0] for frame in frames) / len(frames)
+    if n_frames > 0:
+        avg_brightness, motion_score = _brightness_motion(frames[:n_frames])
         if avg_brightness > 150:
             style_tags.append('明亮')
         elif avg_brightness < 100:
             style_tags.append('暗色调')
 
-        motion_score = 0
-        for i in range(1, len(frames)):
-            diff = cv2.absdiff(frames[i-1], frames[i])
-            motion_score += cv2.mean(diff)[0]
-
-        if motion_score / len(frames) > 50:
+        if motion_score / n_frames > 50:
             style_tags.append('动态')
         else:
             style_tags.append('静态')
 
-    return {
+    result = {
         'style_tags': style_tags,
-        'frame_count': len(frames),
+        'frame_count': n_frames,
         'fps': fps,
         'duration': frame_count / fps if fps > 0 else 0,
         'resolution': f"{int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))}x{int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))}"
     }
 
+    if use_cache:
+        try:
+            redis_client.setex(cache_key, 86400, orjson.dumps(result))
+        except Exception as e:
+            print(f"⚠️ 写入分析缓存失败: {str(e)}")
+
+    return result
+
 
 def generate_digital_human_video(task_data):
     script = task_data.get('script', '')
@@ -120,6 +230,12 @@ def generate_digital_human_video(task_data):
     }
 
 
+def _run_slice(input_path, output_path, start_time, duration, input_args, vcodec):
+    stream = ffmpeg.input(input_path, ss=start_time, t=duration, **input_args)
+    stream = ffmpeg.output(stream, output_path, vcodec=vcodec, acodec='aac')
+    ffmpeg.run(stream, overwrite_output=True)
+
+
 def process_video_file(task_data):
     operation = task_data.get('operation', 'slice')
     input_path = task_data.get('input_path')
@@ -133,9 +249,14 @@ def process_video_file(task_data):
     if operation == 'slice':
         start_time = task_data.get('start_time', 0)
         duration = task_data.get('duration', 10)
-        stream = ffmpeg.input(input_path, ss=start_time, t=duration)
-        stream = ffmpeg.output(stream, output_path, vcodec='libx264', acodec='aac')
-        ffmpeg.run(stream, overwrite_output=True)
+        try:
+            _run_slice(input_path, output_path, start_time, duration, FFMPEG_INPUT_ARGS, FFMPEG_VCODEC)
+        except ffmpeg.Error:
+            if not FFMPEG_CUDA:
+                raise
+            # NVENC 会话数有上限，并发多时可能失败，退回软件编码重跑一次
+            print(f"⚠️ NVENC 处理失败，改用 libx264 重试: {input_path}")
+            _run_slice(input_path, output_path, start_time, duration, {}, 'libx264')
 
     return {
         'output_path': output_path,
@@ -144,6 +265,14 @@ def process_video_file(task_data):
     }
 
 
+_TASK_HANDLERS = {
+    'video_generation': generate_video_with_sora,
+    'video_analysis': analyze_video_style,
+    'digital_human': generate_digital_human_video,
+    'video_processing': process_video_file,
+}
+
+
 def update_task_status(task_id, status, progress, result=None, error=None):
     status_data = {
         "task_id": task_id,
@@ -157,27 +286,154 @@ def update_task_status(task_id, status, progress, result=None, error=None):
     if error is not None:
         status_data["error"] = error
 
-    redis_client.setex(f"task:{task_id}", 3600, json.dumps(status_data))
+    _STATUS_QUEUE.put((f"task:{task_id}", orjson.dumps(status_data)))
 
 
-def run_worker():
-    print("🚀 AI Worker 已启动，监听任务队列 pending_task:* ...")
+# 状态写入攒 20ms / 100 条走一次 pipeline；None 为退出信号
+_STATUS_QUEUE = queue.Queue()
+STATUS_FLUSH_INTERVAL = 0.02
+STATUS_FLUSH_MAX = 100
+
 
+def _status_flusher():
     while True:
+        item = _STATUS_QUEUE.get()
+        if item is None:
+            return
+
+        batch = [item]
+        stop = False
+        deadline = time.monotonic() + STATUS_FLUSH_INTERVAL
+        while len(batch) < STATUS_FLUSH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _STATUS_QUEUE.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+
         try:
-            task_keys = redis_client.keys("pending_task:*")
+            pipe = redis_client.pipeline(transaction=False)
+            for key, payload in batch:
+                pipe.setex(key, 3600, payload)
+            pipe.execute()
+        except Exception as e:
+            print(f"⚠️ 状态写入失败: {len(batch)} 条, 错误: {str(e)}")
+
+        if stop:
+            return
+
+
+_status_thread = threading.Thread(target=_status_flusher, daemon=True)
+_status_thread.start()
+
+
+def migrate_legacy_tasks():
+    # 旧版生产者写入 pending_task:* 键，由 _legacy_migrator 每秒搬到 pending_tasks 列表
+    migrated = 0
+    cursor = 0
+
+    while True:
+        cursor, task_keys = redis_client.scan(cursor, match="pending_task:*", count=500)
+
+        if task_keys:
+            # GETDEL 单键原子，多个 worker 同时迁移也不会重复取到同一任务
+            pipe = redis_client.pipeline(transaction=False)
             for key in task_keys:
-                raw = redis_client.get(key)
-                if not raw:
-                    redis_client.delete(key)
-                    continue
+                pipe.getdel(key)
+            results = pipe.execute()
 
-                task_data = json.loads(raw)
-                redis_client.delete(key)
+            raws = [raw for raw in results if raw]
+            if raws:
+                redis_client.rpush("pending_tasks", *raws)
+                migrated += len(raws)
 
-                process_video_task(task_data)
+        if cursor == 0:
+            break
 
+    if migrated:
+        print(f"📦 迁移旧任务: {migrated} 个")
+    return migrated
+
+
+def _legacy_migrator():
+    # 独立线程按固定间隔迁移，不依赖 BLPOP 是否空闲超时
+    while True:
+        try:
+            migrate_legacy_tasks()
         except Exception as e:
-            print(f"⚠️ Worker 错误: {str(e)}")
+            print(f"⚠️ 旧任务迁移失败: {str(e)}")
+        if _shutdown.wait(1):
+            return
+
+
+def _on_task_done(future):
+    # 没人读 Future，任务体外抛出的异常在这里打出来，否则会被静默吞掉
+    _inflight.release()
+    if not future.cancelled() and future.exception() is not None:
+        print(f"⚠️ Worker 错误: {str(future.exception())}")
+
+
+def _handle_sigterm(signum, frame):
+    print("🛑 收到 SIGTERM，处理完当前任务后退出 ...")
+    _shutdown.set()
+
+
+def run_worker():
+    print("🚀 AI Worker 已启动，监听任务队列 pending_tasks ...")
+
+    # 信号处理只能在主线程注册（被其它线程调用时跳过）
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, _handle_sigterm)
+
+    migrate_thread = threading.Thread(target=_legacy_migrator, daemon=True)
+    migrate_thread.start()
+
+    try:
+        while not _shutdown.is_set():
+            # 带超时等空位，任务全忙时也能及时响应 SIGTERM
+            if not _inflight.acquire(timeout=1):
+                continue
+            if _shutdown.is_set():
+                _inflight.release()
+                break
+
+            try:
+                popped = redis_client.blpop("pending_tasks", timeout=5)
+                if not popped:
+                    _inflight.release()
+                    continue
 
-        time.sleep(1)
+                # BLPOP 期间收到 SIGTERM：放回队首交给其它 worker，不再接新任务
+                if _shutdown.is_set():
+                    redis_client.lpush("pending_tasks", popped[1])
+                    _inflight.release()
+                    break
+
+                task_data = orjson.loads(popped[1])
+
+                future = EXECUTOR.submit(process_video_task, task_data)
+                future.add_done_callback(_on_task_done)
+
+            except Exception as e:
+                _inflight.release()
+                print(f"⚠️ Worker 错误: {str(e)}")
+                # Redis 不可用时别空转
+                _shutdown.wait(1)
+    finally:
+        # 异常 / KeyboardInterrupt 退出也要等任务跑完并写完排队的状态
+        _shutdown.set()
+        migrate_thread.join()
+        EXECUTOR.shutdown(wait=True)
+        _STATUS_QUEUE.put(None)
+        _status_thread.join()
+        print("👋 AI Worker 已退出")
+
+
+if __name__ == "__main__":
+    run_worker()
@@ -1,15 +1,13 @@
 from flask import Flask
-import threading
-from processor_worker import run_worker
 
 app = Flask(__name__)
 
 @app.route("/")
 def home():
-    return "worker running"
+    return "web ok (tasks are consumed by the processor_worker service)"
 
-# ⭐ Flask 加载时启动 worker 主循环
-threading.Thread(target=run_worker, daemon=True).start()
+# ⭐ worker 主循环单独进程运行：python -m processor_worker
+#    Render 上是 render.yaml 里的 background worker 服务，其它平台见 Procfile
 
 # ⭐ Render 需要 Flask 监听 PORT
 if __name__ != "__main__":